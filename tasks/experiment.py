@@ -1,11 +1,23 @@
 import argparse
+import gc
+import hashlib
 import json
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from copy import deepcopy
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import soundfile as sf
+import torch
 from dataset import ManualDataSet
+from librosa import resample
 from librosa.core import load
 from ml.models.model_manager import BaseModelManager
 from ml.models.pretrained_models import supported_pretrained_models
@@ -14,8 +26,24 @@ from ml.src.metrics import metrics2df, Metric
 from ml.src.preprocessor import Preprocessor, preprocess_args
 from ml.tasks.train_manager import TrainManager, train_manager_args
 from ml.src.gradcam import gradcam_main
+from numba import njit
 
 DATALOADERS = {'normal': set_dataloader, 'ml': set_ml_dataloader}
+ROOT_DIR = Path(__file__).resolve().parents[1]
+DATA_DIR = ROOT_DIR / 'input'
+OUTPUT_DIR = ROOT_DIR / 'output'
+PARAMS_DIR = OUTPUT_DIR / 'params'
+METRICS_DIR = OUTPUT_DIR / 'metrics'
+WAVE_CACHE_DIR = DATA_DIR / 'wave_cache'
+AUDIO_CONF = {'HSS': {'sr': 4000, 'one_audio_sec': 10}, 'CinC': {'sr': 2000, 'one_audio_sec': 60}}
+PARAMS_DIR.mkdir(exist_ok=True, parents=True)
+METRICS_DIR.mkdir(exist_ok=True, parents=True)
+# Preprocessors of the current (model, lr) sweep iteration, cleared by __main__ when the iteration ends
+PREPROCESSORS = {}
+CINC_TEST_METRIC_NAMES = ['uar', 'recall_1', 'specificity', 'f1']
+HEADER_LABEL_PATTERN = re.compile(rb'# ([^\r\n]*)\s*\Z')
+
+logger = logging.getLogger(__name__)
 
 
 def train_args(parser):
@@ -25,6 +53,11 @@ def train_args(parser):
     expt_parser.add_argument('--data-source', help='HSS 1.0 or CinC', default='HSS', choices=['HSS', 'CinC'])
     expt_parser.add_argument('--dataloader-type', help='Dataloader type.', choices=['normal', 'ml'], default='normal')
     expt_parser.add_argument('--gradcam', action='store_true', default=False)
+    expt_parser.add_argument('--n-parallel', help='Number of seeds to run in parallel', default=1, type=int)
+    expt_parser.add_argument('--wave-cache', help='Cache length-normalized waves into memmap', action='store_true',
+                             default=False)
+    # Decode waves in several loader worker processes; seeds run with --n-parallel use n_jobs=0 instead
+    parser.set_defaults(n_jobs=min(8, os.cpu_count() or 1))
 
     return parser
 
@@ -38,80 +71,231 @@ def cinc_label_func(row):
     return converter[row[1]]
 
 
-def set_load_func(sr, one_audio_sec):
+def get_preprocessor(train_conf, phase, sr):
+    key = (phase, sr)
+    if key not in PREPROCESSORS:
+        PREPROCESSORS[key] = Preprocessor(train_conf, phase, sr)
+    return PREPROCESSORS[key]
+
+
+@njit(cache=True)
+def _place_center(wave, out):
+    n = min(wave.shape[0], out.shape[0])
+    offset = (out.shape[0] - n) // 2
+    for i in range(n):
+        out[offset + i] = wave[i]
+
+
+def _decode_wave(path, sr, const_length):
+    try:
+        # Only the first const_length samples are used, so the rest of the file is never decoded
+        with sf.SoundFile(path) as f:
+            file_sr = f.samplerate
+            n_frames = const_length if file_sr == sr else int(np.ceil(const_length * file_sr / sr))
+            wave = f.read(frames=n_frames, dtype='float32', always_2d=False)
+        if wave.ndim > 1:
+            wave = wave.mean(axis=1)
+        if file_sr != sr:
+            wave = resample(wave, orig_sr=file_sr, target_sr=sr, res_type='kaiser_fast')
+    except RuntimeError:
+        # libsndfile cannot decode this format, fall back to audioread
+        wave = load(path, sr=sr, duration=const_length / sr)[0]
+    out = np.zeros((1, const_length), dtype=np.float32)
+    _place_center(wave, out[0])
+    return out
+
+
+def _files_digest(paths, salt=''):
+    h = hashlib.blake2b(salt.encode())
+    for p in sorted(paths):
+        h.update(str(p).encode())
+        h.update(str(p.stat().st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def _manifest_up_to_date(hash_path, digest, manifest_paths):
+    return hash_path.exists() and hash_path.read_text() == digest and all(p.exists() for p in manifest_paths)
+
+
+def _wave_cache_paths(manifest_path, sr, one_audio_sec, out_dir):
+    stem = f'{Path(manifest_path).stem}_{sr}hz_{one_audio_sec}s'
+    return Path(out_dir) / f'{stem}_waves.npy', Path(out_dir) / f'{stem}.json'
+
+
+def _cached_waves_shape(waves_path):
+    if not waves_path.exists():
+        return None
+    try:
+        return np.load(waves_path, mmap_mode='r').shape
+    except ValueError:
+        # Header of a .npy whose write never finished
+        return None
+
+
+def precompute_waveforms(manifest_path, sr, one_audio_sec, out_dir=WAVE_CACHE_DIR):
+    """Decode every wave in the manifest once and store them as a (N, 1, sr * one_audio_sec) memmap.
+
+    Nothing is decoded when the cache for the same files, mtimes, sr and one_audio_sec already exists.
+    Returns the path of the meta file to pass to set_load_func. Call this once before the sweep, not from
+    experiments running in parallel.
+    """
+    manifest = pd.read_csv(manifest_path, header=None)
+    file_names = manifest.iloc[:, 0].astype(str).tolist()
+
+    digest = _files_digest([Path(file_name) for file_name in file_names], salt=f'{sr}_{one_audio_sec}')
+
+    const_length = sr * one_audio_sec
+    waves_path, meta_path = _wave_cache_paths(manifest_path, sr, one_audio_sec, out_dir)
+    if meta_path.exists() and json.loads(meta_path.read_text())['hash'] == digest and \
+            _cached_waves_shape(waves_path) == (len(file_names), 1, const_length):
+        return meta_path
+
+    Path(out_dir).mkdir(exist_ok=True, parents=True)
+    if meta_path.exists():
+        meta_path.unlink()
+    waves = np.lib.format.open_memmap(waves_path, mode='w+', dtype=np.float32,
+                                      shape=(len(file_names), 1, const_length))
+    for i, file_name in enumerate(file_names):
+        waves[i] = _decode_wave(file_name, sr, const_length)
+    waves.flush()
+    del waves
+
+    meta = {'hash': digest, 'sr': sr, 'one_audio_sec': one_audio_sec, 'file_names': file_names}
+    meta_path.write_text(json.dumps(meta))
+    return meta_path
+
+
+def set_load_func(sr, one_audio_sec, cache_meta_paths=None):
+    const_length = sr * one_audio_sec
+
     def load_func(path):
-        const_length = sr * one_audio_sec
-        wave = load(path[0], sr=sr)[0]
-        if wave.shape[0] > const_length:
-            wave = wave[:const_length]
-        elif wave.shape[0] < const_length:
-            n_pad = (const_length - wave.shape[0]) // 2 + 1
-            wave = np.pad(wave[:const_length], n_pad)[:const_length]
-        return wave.reshape((1, -1))
+        return _decode_wave(path[0], sr, const_length)
 
-    return load_func
+    if not cache_meta_paths:
+        return load_func
 
+    row_ids = {}
+    for meta_path in map(Path, cache_meta_paths):
+        meta = json.loads(meta_path.read_text())
+        assert (meta['sr'], meta['one_audio_sec']) == (sr, one_audio_sec), \
+            f'{meta_path} was not cached with sr={sr}, one_audio_sec={one_audio_sec}'
+        waves = np.load(meta_path.with_name(f'{meta_path.stem}_waves.npy'), mmap_mode='r')
+        for i, file_name in enumerate(meta['file_names']):
+            row_ids[file_name] = (waves, i)
+
+    def cached_load_func(path):
+        if path[0] not in row_ids:
+            return load_func(path)
+        waves, i = row_ids[path[0]]
+        return np.array(waves[i])
+
+    return cached_load_func
+
+
+def _write_manifest(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pa_csv.write_csv(table, str(path), write_options=pa_csv.WriteOptions(include_header=False))
+
+
+def _scan_dir(directory):
+    # Resolve the directory once instead of calling resolve() on every entry
+    base = directory.resolve()
+    with os.scandir(base) as it:
+        return [base / entry.name for entry in it]
+
+
+def _bucket_by_phase(wav_paths, phases):
+    dic = {phase: [] for phase in phases}
+    for p in wav_paths:
+        for phase in phases:
+            if phase in p.name:
+                dic[phase].append(str(p))
+                break
+    for paths in dic.values():
+        paths.sort()
+    return dic
 
-def create_hss_manifest():
-    DATA_DIR = Path(__file__).resolve().parents[1] / 'input'
 
+def create_hss_manifest():
     db = '1'
     # db = '1.5'
     if db == '1':
-        dic = {}
-        for phase in ['train', 'devel', 'test']:
-            dic[phase] = [str(p.resolve()) for p in (DATA_DIR / 'wav').iterdir() if phase in p.name]
-            dic[phase].sort()
+        wav_paths = _scan_dir(DATA_DIR / 'wav')
+        label_paths = [DATA_DIR / 'lab' / 'labels_train_dev.tsv', DATA_DIR / 'lab' / 'labels_test.txt']
+        manifest_paths = [DATA_DIR / f'{phase}_manifest.csv' for phase in ['train', 'val', 'test']]
+        hash_path = DATA_DIR / '.hss_manifest.hash'
+        digest = _files_digest(wav_paths + label_paths)
+        if _manifest_up_to_date(hash_path, digest, manifest_paths):
+            return
+
+        dic = _bucket_by_phase(wav_paths, ['train', 'devel', 'test'])
 
         train_dev_label = pd.read_csv(DATA_DIR / 'lab' / 'labels_train_dev.tsv', sep='\t')
         test = pd.read_csv(DATA_DIR / 'lab' / 'labels_test.txt', header=None)
 
-        train = train_dev_label.iloc[:len(dic['train']), :]
-        train['file_name'] = dic['train']
+        train = train_dev_label.iloc[:len(dic['train']), :].assign(file_name=dic['train'])
         # train = train[train['label'] != 2]
-        train.to_csv(DATA_DIR / 'train_manifest.csv', index=False, header=None)
+        _write_manifest(train, DATA_DIR / 'train_manifest.csv')
 
         val = train_dev_label.iloc[len(dic['train']):, :]
         assert val.shape[0] == len(dic['devel'])
-        val['file_name'] = dic['devel']
+        val = val.assign(file_name=dic['devel'])
         # val = val[val['label'] != 2]
-        val.to_csv(DATA_DIR / 'val_manifest.csv', index=False, header=None)
+        _write_manifest(val, DATA_DIR / 'val_manifest.csv')
 
-        test[0] = dic['test']
         test.columns = ['file_name', 'label']
+        test = test.assign(file_name=dic['test'])
         # test = test[test['label'] != 2]
-        test.to_csv(DATA_DIR / 'test_manifest.csv', index=False, header=None)
+        _write_manifest(test, DATA_DIR / 'test_manifest.csv')
+        hash_path.write_text(digest)
 
     elif db == '1.5':
-        for phase in ['train', 'devel', 'test']:
-            phase_dic = [str(p.resolve()) for p in (DATA_DIR / 'db1-5' / 'wav').iterdir() if phase in p.name]
-            phase_dic.sort()
-
-            df = pd.read_csv(DATA_DIR / 'db1-5' / 'lab' / f'labels_{phase}.tsv', sep='\t')
-            df['file_name'] = phase_dic
-            df.to_csv(DATA_DIR / f'db15_{phase}_manifest.csv', index=False, header=None)
+        wav_paths = _scan_dir(DATA_DIR / 'db1-5' / 'wav')
+        label_paths = [DATA_DIR / 'db1-5' / 'lab' / f'labels_{phase}.tsv' for phase in ['train', 'devel', 'test']]
+        manifest_paths = [DATA_DIR / f'db15_{phase}_manifest.csv' for phase in ['train', 'devel', 'test']]
+        hash_path = DATA_DIR / '.hss15_manifest.hash'
+        digest = _files_digest(wav_paths + label_paths)
+        if _manifest_up_to_date(hash_path, digest, manifest_paths):
+            return
+
+        dic = _bucket_by_phase(wav_paths, ['train', 'devel', 'test'])
+        for phase, label_path, manifest_path in zip(['train', 'devel', 'test'], label_paths, manifest_paths):
+            df = pd.read_csv(label_path, sep='\t')
+            df = df.assign(file_name=dic[phase])
+            _write_manifest(df, manifest_path)
+        hash_path.write_text(digest)
 
 
 def create_cinc_manifest():
-    DATA_DIR = Path(__file__).resolve().parents[1] / 'input'
-
     head_paths = []
     wav_paths = []
-    training_folders = [path.resolve() for path in (DATA_DIR / 'cinc').iterdir() if path.name.startswith('training-')]
+    training_folders = [path for path in _scan_dir(DATA_DIR / 'cinc') if path.name.startswith('training-')]
     for training_folder in training_folders:
-        head_paths.extend([p for p in training_folder.iterdir() if p.name.endswith('.hea')])
-        wav_paths.extend([p for p in training_folder.iterdir() if p.name.endswith('.wav')])
+        for p in _scan_dir(training_folder):
+            if p.name.endswith('.hea'):
+                head_paths.append(p)
+            elif p.name.endswith('.wav'):
+                wav_paths.append(p)
     head_paths.sort()
     wav_paths.sort()
 
+    manifest_path = DATA_DIR / 'cinc_manifest.csv'
+    hash_path = DATA_DIR / '.cinc_manifest.hash'
+    digest = _files_digest(head_paths + wav_paths)
+    if _manifest_up_to_date(hash_path, digest, [manifest_path]):
+        return
+
     labels = []
     for head, wav in zip(head_paths, wav_paths):
         assert head.name[:-4] == wav.name[:-4]
-        with open(head, 'r') as f:
-            labels.append(f.read().split('# ')[-1].replace('\n', ''))
+        match = HEADER_LABEL_PATTERN.search(head.read_bytes())
+        if match is None:
+            raise ValueError(f"{head} has no trailing '# <label>' line")
+        labels.append(match.group(1).decode())
 
-    manifest = pd.DataFrame([wav_paths, labels]).T
-    manifest.to_csv(DATA_DIR / 'cinc_manifest.csv', header=None, index=False)
+    manifest = pd.DataFrame({'file_name': [str(p) for p in wav_paths], 'label': labels})
+    _write_manifest(manifest, manifest_path)
+    hash_path.write_text(digest)
 
 
 def hss_experiment(train_conf) -> float:
@@ -124,13 +308,13 @@ def hss_experiment(train_conf) -> float:
 
     train_conf['prev_classes'] = [0, 1]
 
-    one_audio_sec = 10
-    sr = 4000
+    one_audio_sec = AUDIO_CONF['HSS']['one_audio_sec']
+    sr = AUDIO_CONF['HSS']['sr']
 
+    load_func = set_load_func(sr, one_audio_sec, train_conf.get('wave_cache_metas'))
     dataloaders = {}
     for phase in phases:
-        process_func = Preprocessor(train_conf, phase, sr).preprocess
-        load_func = set_load_func(sr, one_audio_sec)
+        process_func = get_preprocessor(train_conf, phase, sr).preprocess
         dataset = ManualDataSet(train_conf[f'{phase}_path'], train_conf, load_func, process_func, hss_label_func, phase)
         dataloaders[phase] = DATALOADERS[train_conf['dataloader_type']](dataset, phase, train_conf)
 
@@ -143,25 +327,29 @@ def hss_experiment(train_conf) -> float:
 
     model_manager.train()
     _, _, metrics = model_manager.test(return_metrics=True)
-    del model_manager.model
+    del model_manager.model, model_manager
     uar = [metric for metric in metrics if metric.name == 'uar'][0]
 
-    (Path(__file__).resolve().parent.parent / 'output' / 'params').mkdir(exist_ok=True)
-    with open(Path(__file__).resolve().parent.parent / 'output' / 'params' / f"{train_conf['log_id']}.txt", 'w') as f:
+    with open(PARAMS_DIR / f"{train_conf['log_id']}.txt", 'w') as f:
         f.write('\nParameters:\n')
         f.write(json.dumps(train_conf, indent=4))
 
-    (Path(__file__).resolve().parent.parent / 'output' / 'metrics').mkdir(exist_ok=True)
-    metrics2df(metrics, phase='test').to_csv(
-        Path(__file__).resolve().parent.parent / 'output' / 'metrics' / f"{train_conf['log_id']}_test.csv", index=False)
+    metrics2df(metrics, phase='test').to_csv(METRICS_DIR / f"{train_conf['log_id']}_test.csv", index=False)
 
     return uar.average_meter['test'].value
 
 
+def set_train_val_metrics():
+    return [
+        Metric('loss', direction='minimize', save_model=True),
+        Metric('uar', direction='maximize'),
+    ]
+
+
 def cv_experiment(train_conf) -> float:
     phases = ['train', 'val', 'test']
-    one_audio_sec = 60
-    sr = 2000
+    one_audio_sec = AUDIO_CONF['CinC']['one_audio_sec']
+    sr = AUDIO_CONF['CinC']['sr']
 
     if train_conf['task_type'] == 'regress':
         train_conf['class_names'] = [0]
@@ -172,12 +360,7 @@ def cv_experiment(train_conf) -> float:
 
     dataset_cls = ManualDataSet
     set_dataloader_func = set_dataloader
-    process_func = Preprocessor(train_conf, phase='test', sr=sr).preprocess
-
-    train_val_metrics = [
-        Metric('loss', direction='minimize', save_model=True),
-        Metric('uar', direction='maximize'),
-    ]
+    process_func = get_preprocessor(train_conf, phase='test', sr=sr).preprocess
 
     test_metrics = [
         Metric('loss', direction='minimize', save_model=True),
@@ -186,32 +369,95 @@ def cv_experiment(train_conf) -> float:
         Metric('specificity', direction='maximize'),
         Metric('f1', direction='maximize'),
     ]
-    metrics = {'train': deepcopy(train_val_metrics), 'val': train_val_metrics, 'test': test_metrics}
+    metrics = {'train': set_train_val_metrics(), 'val': set_train_val_metrics(), 'test': test_metrics}
 
-    load_func = set_load_func(sr, one_audio_sec)
+    load_func = set_load_func(sr, one_audio_sec, train_conf.get('wave_cache_metas'))
     train_manager = TrainManager(train_conf, load_func, cinc_label_func, dataset_cls, set_dataloader_func, metrics,
                                  process_func=process_func)
     model_manager, val_cv_metrics, test_cv_metrics = train_manager.train_test()
+    del model_manager, train_manager
 
-    (Path(__file__).resolve().parent.parent / 'output' / 'params').mkdir(exist_ok=True)
-    with open(Path(__file__).resolve().parent.parent / 'output' / 'params' / f"{train_conf['log_id']}.txt", 'w') as f:
+    with open(PARAMS_DIR / f"{train_conf['log_id']}.txt", 'w') as f:
         f.write('\nParameters:\n')
         f.write(json.dumps(train_conf, indent=4))
 
-    (Path(__file__).resolve().parent.parent / 'output' / 'metrics').mkdir(exist_ok=True)
-    metrics2df(test_cv_metrics, phase='test').to_csv(
-        Path(__file__).resolve().parent.parent / 'output' / 'metrics' / f"{train_conf['log_id']}_test.csv", index=False)
+    metrics2df(test_cv_metrics, phase='test').to_csv(METRICS_DIR / f"{train_conf['log_id']}_test.csv", index=False)
 
     return val_cv_metrics['uar'].mean(), test_cv_metrics
 
 
+def free_gpu_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+
+def is_oom_error(e):
+    return 'out of memory' in str(e)
+
+
+def run_hss_seed(train_conf) -> float:
+    try:
+        return hss_experiment(train_conf)
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise
+        logger.warning(f"{train_conf['model_type']} lr={train_conf['lr']} seed={train_conf['seed']} ran out of "
+                       f"memory, skipped: {e}")
+        return np.nan
+    finally:
+        free_gpu_memory()
+
+
+def run_cv_experiment(train_conf):
+    try:
+        return cv_experiment(train_conf)
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise
+        logger.warning(f"{train_conf['model_type']} lr={train_conf['lr']} ran out of memory, skipped: {e}")
+        return np.nan, {metric_name: np.nan for metric_name in CINC_TEST_METRIC_NAMES}
+    finally:
+        free_gpu_memory()
+
+
+def _pin_gpu(gpu_ids):
+    # Runs before anything touches CUDA in the worker, so the ml package's cuda:0 is this worker's GPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpu_ids.get()
+
+
+def run_parallel_hss_seeds(seed_confs, n_parallel, cuda):
+    # spawn, because CUDA cannot be used in workers forked from a process that imported torch
+    ctx = multiprocessing.get_context('spawn')
+    initializer, initargs = None, ()
+    if cuda:
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        gpus = visible.split(',') if visible else [str(i) for i in range(torch.cuda.device_count())]
+        gpu_ids = ctx.Queue()
+        for gpu in gpus[:n_parallel]:
+            gpu_ids.put(gpu)
+        initializer, initargs = _pin_gpu, (gpu_ids,)
+
+    with ProcessPoolExecutor(max_workers=n_parallel, mp_context=ctx, initializer=initializer,
+                             initargs=initargs) as executor:
+        return list(executor.map(run_hss_seed, seed_confs))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='train arguments')
     train_conf = vars(train_args(preprocess_args(parser)).parse_args())
     assert train_conf['train_path'] != '' or train_conf['val_path'] != '', \
         'You need to select training, validation data file to training, validation in --train-path, --val-path argments'
+    assert not train_conf['cuda'] or train_conf['n_parallel'] <= max(torch.cuda.device_count(), 1), \
+        f"--n-parallel {train_conf['n_parallel']} needs as many visible GPUs, one per seed"
     
-    test_metric_names = ['uar', 'recall_1', 'specificity', 'f1']
+    if train_conf['data_source'] == 'HSS':
+        # hss_experiment only reports test uar
+        test_metric_names = ['uar']
+    else:
+        test_metric_names = CINC_TEST_METRIC_NAMES
+    n_seeds = 5
 
     if train_conf['gradcam']:
         # Gradcam
@@ -232,9 +478,21 @@ if __name__ == '__main__':
     elif train_conf['data_source'] == 'CinC':
         create_cinc_manifest()
 
-    results = {metric_name: [] for metric_name in test_metric_names}
+    if train_conf['wave_cache']:
+        if train_conf['data_source'] == 'HSS':
+            manifest_paths = [train_conf[f'{phase}_path'] for phase in ['train', 'val', 'test']]
+        else:
+            manifest_paths = [train_conf['manifest_path']]
+        audio_conf = AUDIO_CONF[train_conf['data_source']]
+        train_conf['wave_cache_metas'] = [
+            str(precompute_waveforms(manifest_path, audio_conf['sr'], audio_conf['one_audio_sec']))
+            for manifest_path in manifest_paths]
+
+    models = ['vgg16', 'vgg19', 'resnet', 'mobilenet', 'resnext']
+    lrs = [0.0001, 0.00001]
+    results = np.empty((len(test_metric_names), len(models), len(lrs)), dtype=np.float64)
     val_results = []
-    for model in ['vgg16', 'vgg19', 'resnet', 'mobilenet', 'resnext']:
+    for model_idx, model in enumerate(models):
     # for model in ['vgg16', 'vgg19']:
     # for model in ['resnext101', 'resnext101_wsl']:
 
@@ -247,28 +505,50 @@ if __name__ == '__main__':
         #     train_conf['transform'] = preprocess
         #     train_conf['log_id'] = 'mobilenet-' + preprocess
 
-        for lr in [0.0001, 0.00001]:
+        for lr_idx, lr in enumerate(lrs):
             train_conf['lr'] = lr
-            uar_res = {metric_name: [] for metric_name in test_metric_names}
+            uar_res = {}
             val_uar_res = []
 
             if train_conf['data_source'] == 'HSS':
-                for seed in range(5):
-                    train_conf['seed'] = seed
-                    uar_res.append(hss_experiment(train_conf))
+                seed_confs = []
+                for seed in range(n_seeds):
+                    seed_conf = deepcopy(train_conf)
+                    seed_conf['seed'] = seed
+                    seed_conf['log_id'] = f"{train_conf['log_id']}_{model}_{lr}_seed-{seed}"
+                    if train_conf['n_parallel'] > 1:
+                        # Parallel seeds need their own checkpoint next to the configured one
+                        model_path = Path(train_conf['model_path'])
+                        seed_conf['model_path'] = str(model_path.with_name(f'{model_path.stem}_seed-{seed}'
+                                                                           f'{model_path.suffix}'))
+                        seed_conf['n_jobs'] = 0
+                    seed_confs.append(seed_conf)
+
+                if train_conf['n_parallel'] == 1:
+                    seed_uars = [run_hss_seed(seed_conf) for seed_conf in seed_confs]
+                else:
+                    seed_uars = run_parallel_hss_seeds(seed_confs, train_conf['n_parallel'], train_conf['cuda'])
+                uar_arr = np.empty(n_seeds, dtype=np.float64)
+                uar_arr[:] = seed_uars
+                uar_res['uar'] = uar_arr
             elif train_conf['data_source'] == 'CinC':
-                val_uar, test_metrics = cv_experiment(train_conf)
+                val_uar, test_metrics = run_cv_experiment(train_conf)
                 val_uar_res.append(val_uar)
                 for metric_name in test_metric_names:
-                    uar_res[metric_name].append(test_metrics[metric_name].mean())
+                    uar_res[metric_name] = np.array([np.mean(test_metrics[metric_name])])
 
             # print(np.array(uar_res).mean())
             # print(np.array(uar_res).std())
             val_results.append(np.array(val_uar_res).mean())
-            for metric_name in test_metric_names:
-                results[metric_name].append(np.array(uar_res[metric_name]).mean())
+            for metric_idx, metric_name in enumerate(test_metric_names):
+                results[metric_idx, model_idx, lr_idx] = uar_res[metric_name].mean()
+
+            PREPROCESSORS.clear()
+            free_gpu_memory()
 
-    expt_path = Path(__file__).resolve().parent.parent / 'output' / f"{train_conf['log_id']}.csv"
+    expt_path = OUTPUT_DIR / f"{train_conf['log_id']}.csv"
+    results_df = pd.DataFrame(results.reshape(len(test_metric_names), -1).T, columns=test_metric_names,
+                              index=pd.MultiIndex.from_product([models, lrs], names=['model', 'lr']))
     print(val_results)
-    print(results)
-    # pd.DataFrame(results, index=list(supported_pretrained_models.keys())).T.to_csv(expt_path, index=False)
+    print(results_df)
+    results_df.to_csv(expt_path)